@@ -1,16 +1,56 @@
 from dataclasses import dataclass
-import nfc, logging, os, time, uuid, sys, sqlite3, argparse, mimetypes, pexpect, signal
+import logging.handlers
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import logging, os, time, sys, sqlite3, argparse, mimetypes, pexpect, signal, threading
 from ndef import TextRecord
 from ndef import message_decoder
-from operator import xor
-from tkinter import filedialog, TclError
 
 _VERSION = "1.0"
 
 mimetypes.init()
 
+# Only X11 style platforms announce a display through DISPLAY. Windows and macOS always have one,
+# and if Tk still can't open there the file dialog falls back to terminal mode.
+if os.name == 'posix' and sys.platform != 'darwin':
+    _HAS_DISPLAY = 'DISPLAY' in os.environ
+else:
+    _HAS_DISPLAY = True
+
+# FeliCa polling request sent to every target on startup.
+_SENSF_REQ = bytes.fromhex("0012FC0000")
+
+_PLAYLIST_EXTS = frozenset({".m3u", ".asx", ".xspf", ".b4s", ".cue"})
+# Playlist formats are registered as audio types, leave them out.
+_AUDIO_EXTS = frozenset(ext for ext, mime_type in mimetypes.types_map.items() if mime_type.startswith("audio")) - _PLAYLIST_EXTS
+
 def clear_screen():
-    os.system('cls' if os.name == 'nt' else 'clear')
+    # Legacy Windows consoles don't understand ANSI escapes, everything else gets them directly instead of a shell.
+    if os.name == 'nt' and not os.environ.get('WT_SESSION'):
+        os.system('cls')
+    else:
+        sys.stdout.write('\x1b[2J\x1b[H')
+        sys.stdout.flush()
+
+def prefetch_file(path):
+    """ Ask the kernel to start reading a file into the page cache. """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+_CROCKFORD_BASE32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+def new_tag_uuid():
+    """ Time-ordered tag ID: the NFCMP_ prefix followed by a ULID (48 bit ms timestamp + 80 random bits in Crockford base32). """
+    value = ((time.time_ns() // 1000000) << 80) | int.from_bytes(os.urandom(10), "big")
+    return "NFCMP_" + "".join(_CROCKFORD_BASE32[(value >> shift) & 0x1F] for shift in range(125, -1, -5))
 
 class TerminalFormatter(logging.Formatter):
 
@@ -29,29 +69,39 @@ class TerminalFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format + reset
     }
 
+    # Built once instead of per record.
+    FORMATTERS = {level: logging.Formatter(log_fmt) for level, log_fmt in FORMATS.items()}
+    default_formatter = logging.Formatter()
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self.FORMATTERS.get(record.levelno, self.default_formatter)
         return formatter.format(record)
 
 class FileFormatter(logging.Formatter):
 
     fileFormat = "%(asctime)s | %(name)s | %(levelname)s | %(message)s"
+    formatter = logging.Formatter(fileFormat)
 
     def format(self, record):
-        formatter = logging.Formatter(self.fileFormat)
-        return formatter.format(record)
+        return self.formatter.format(record)
 
 logger = logging.getLogger(__name__)
 
-fileHandler = logging.FileHandler("nfcp.log")
+fileHandler = logging.handlers.RotatingFileHandler("nfcp.log", maxBytes=1<<20, backupCount=3, delay=True)
 fileHandler.setFormatter(FileFormatter())
-logger.addHandler(fileHandler)
+# Hold records in memory and write them 100 at a time, or right away once an error is logged.
+bufferedFileHandler = logging.handlers.MemoryHandler(capacity=100, flushLevel=logging.ERROR, target=fileHandler)
+logger.addHandler(bufferedFileHandler)
 
 stdoutHandler = logging.StreamHandler()
 stdoutHandler.setFormatter(TerminalFormatter())
 logger.addHandler(stdoutHandler)
 
+_SQL_GET_PATH = "SELECT path FROM music WHERE uuid=?"
+_SQL_GET_ALL = "SELECT uuid, path FROM music"
+_SQL_INSERT = "INSERT INTO music(uuid, path) VALUES(?, ?)"
+_SQL_DELETE = "DELETE FROM music WHERE uuid=?"
+
 class NoTagException(Exception):
     """Tag was not present when running operation."""
     def __init__(self, message):
@@ -83,7 +133,10 @@ class BadEntryException(Exception):
 class Database:
 
     con = None
-    cur = None
+    _tls = None
+    _write_lock = None
+    _uuid_to_path = None
+    _in_transaction = False
     db_ver = 1.0
     db_file_name = "NFCPlayer.db"
 
@@ -91,55 +144,157 @@ class Database:
         logger.debug(f"Initializing database.")
         # Create DB and tables if DB does not exist.
         db_exists = os.path.exists(f"./{self.db_file_name}")
-        self.con = sqlite3.connect(self.db_file_name)
-        self.cur = self.con.cursor()
+        # Shared across threads: each thread gets its own cursor and writes are serialized by _write_lock.
+        # Autocommit mode: reads never open a transaction, writes go through transaction() which issues BEGIN IMMEDIATE.
+        self.con = sqlite3.connect(self.db_file_name, cached_statements=256, check_same_thread=False, isolation_level=None)
+        self._tls = threading.local()
+        self._write_lock = threading.RLock()
+        # WAL journal so a commit is a single append instead of a journal rewrite + fsync.
+        self.cur.execute("PRAGMA journal_mode=WAL")
+        self.cur.execute("PRAGMA synchronous=NORMAL")
+        self.cur.execute("PRAGMA temp_store=MEMORY")
+        self.cur.execute("PRAGMA cache_size=-65536")
+        self.cur.execute("PRAGMA mmap_size=268435456")
+        self.cur.execute("PRAGMA busy_timeout=5000")
+        self.cur.execute("PRAGMA foreign_keys=ON")
         if db_exists == False:
             logger.info("Creating database...")
-            self.cur.execute("CREATE TABLE meta(key, value)")
-            self.cur.execute(f"INSERT INTO meta VALUES ('version', {self.db_ver})")
-            self.cur.execute("CREATE TABLE music(UUID, path)")
-            self.con.commit()
+            with self.con:
+                self.cur.execute("BEGIN")
+                self.cur.execute("CREATE TABLE meta(key, value)")
+                self.cur.execute(f"INSERT INTO meta VALUES ('version', {self.db_ver})")
+                # WITHOUT ROWID stores rows in the UUID b-tree itself, a lookup is one descent instead of index + rowid.
+                self.cur.execute("CREATE TABLE music(UUID TEXT PRIMARY KEY, path TEXT NOT NULL) WITHOUT ROWID")
             logger.info("Done.")
         else:
             logger.info(f"Found NFCPlayer.db.")
+            # Databases created before UUID became the primary key need an index for lookups.
+            # Tables keyed on UUID already have one, a second index would only add a b-tree to every write.
+            if not self.has_primary_key("music"):
+                try:
+                    self.cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_music_uuid ON music(UUID)")
+                except sqlite3.IntegrityError:
+                    logger.warning("DB contains duplicate UUIDs, indexing them without a uniqueness check.")
+                    self.cur.execute("CREATE INDEX IF NOT EXISTS idx_music_uuid ON music(UUID)")
+        self.load_index()
+
+    @property
+    def cur(self):
+        """ Cursor belonging to the calling thread. """
+        cur = getattr(self._tls, "cur", None)
+        if cur is None:
+            cur = self._tls.cur = self.con.cursor()
+        return cur
+
+    def has_primary_key(self, table):
+        """ Check whether a table declares a primary key. """
+        # The pk column of table_info is the column's position in the key, 0 when it isn't part of it.
+        return any(column[5] for column in self.cur.execute(f"PRAGMA table_info({table})"))
+
+    def load_index(self):
+        """ Load every uuid and path into memory so tag lookups don't need a query. """
+        # Build the dict straight from the cursor, no intermediate list of rows.
+        self._uuid_to_path = dict(self.cur.execute(_SQL_GET_ALL))
+        logger.debug(f"Loaded {len(self._uuid_to_path)} entries from DB.")
     
     def get_path(self, uuid, supress_warnings = False):
         """ Get a path from a DB entry, else return none. """
         if uuid is None:
             return None
-        res = self.cur.execute("SELECT path FROM music WHERE uuid=:uuid", {'uuid': uuid}).fetchone()
-        if res == None:
+        path = self._uuid_to_path.get(uuid)
+        if path is None:
+            res = self.cur.execute(_SQL_GET_PATH, (uuid,)).fetchone()
+            if res is not None:
+                path = self._uuid_to_path[uuid] = res[0]
+        if path == None:
             if supress_warnings == False:
                 logger.warning("DB does not contain a path for this tags UUID.")
             return None
         else:
-            path = os.path.normpath(res[0])
-            logger.info(f"Found {path}")
+            path = os.path.normpath(path)
+            logger.info("Found %s", path)
         return path
     
     def get_all_paths(self):
-        """ Get all paths from DB entry, else return none. """
-        res = self.cur.execute("SELECT path FROM music").fetchall()
-        return res
+        """ Get all paths in the DB. """
+        return self._uuid_to_path.values()
 
-    def create_entry(self, uuid, path):
-        """ Add a uuid and a path to the DB. """
+    def is_valid_entry(self, uuid, path):
+        """ Check that neither the uuid nor the path is empty. """
         if (bool(uuid and not uuid.isspace()) == False) or (bool(path and not path.isspace()) == False):
             # Entries is/are empty.
             logger.critical(f"DB entry is not valid: {uuid}, {path}")
+            return False
+        return True
+
+    def create_entry(self, uuid, path):
+        """ Add a uuid and a path to the DB. """
+        self.replace_entry(None, uuid, path)
+
+    def create_entries(self, rows, old_uuids=()):
+        """ Add several (uuid, path) rows to the DB and remove the old_uuids entries, all in a single transaction. """
+        old_uuids = list(old_uuids)
+        with self.transaction():
+            self.cur.executemany(_SQL_DELETE, ((old_uuid,) for old_uuid in old_uuids))
+            for old_uuid in old_uuids:
+                self._uuid_to_path.pop(old_uuid, None)
+            self.cur.executemany(_SQL_INSERT, rows)
+            self._uuid_to_path.update(rows)
+        # Let SQLite refresh its planner statistics after a bulk insert.
+        self.cur.execute("PRAGMA optimize")
+
+    def replace_entry(self, old_uuid, uuid, path):
+        """ Add a uuid and a path to the DB, removing old_uuid's entry (if any) in the same commit. """
+        if self.is_valid_entry(uuid, path) == False:
             return
-        query = 'INSERT INTO music(uuid, path) VALUES(?, ?)'
-        values = (uuid, path)
-        self.cur.execute(query, values)
-        self.con.commit()
+        try:
+            with self.transaction():
+                if old_uuid is not None:
+                    self.remove_entry(old_uuid)
+                # A clash raises out of the block, so the removal is rolled back with it.
+                self.cur.execute(_SQL_INSERT, (uuid, path))
+                self._uuid_to_path[uuid] = path
+        except sqlite3.IntegrityError:
+            logger.critical(f"DB already has an entry for {uuid}, kept the previous entry.")
 
     def remove_entry(self, uuid):
         """ Remove an entry using the UUID as key. """
-        self.cur.execute("DELETE FROM music WHERE uuid=:uuid", {'uuid': uuid})
-        self.con.commit()
+        with self.transaction():
+            self.cur.execute(_SQL_DELETE, (uuid,))
+            self._uuid_to_path.pop(uuid, None)
+
+    def close(self):
+        """ Refresh planner statistics and close the DB. """
+        if self.con is None:
+            return
+        self.cur.execute("PRAGMA optimize")
+        self.con.close()
+        self.con = None
+
+    @contextmanager
+    def transaction(self):
+        """ Commit the DB writes made inside the block together, or none of them. """
+        with self._write_lock:
+            if self._in_transaction:
+                # Nested blocks join the outer transaction.
+                yield
+                return
+            self._in_transaction = True
+            try:
+                with self.con:
+                    # Take the write lock up front rather than upgrading from a read lock mid-transaction.
+                    self.cur.execute("BEGIN IMMEDIATE")
+                    yield
+            except BaseException:
+                # Rolled back, bring the in-memory index back in line with the DB.
+                self.load_index()
+                raise
+            finally:
+                self._in_transaction = False
 
 class VLC:
     process = None
+    state_timeout = 5
     def __init__(self):
         self.process = pexpect.spawn("vlc")
 
@@ -159,25 +314,44 @@ class VLC:
         logger.debug("Sending pause command")
         if( self.get_state() == "playing" ):
             self.process.sendline("pause")
-        logger.debug("Already in a paused/stopped state")
+        else:
+            logger.debug("Already in a paused/stopped state")
 
     def clear_playlist(self):
         logger.debug("Sending stop and clear command")
         self.process.sendline("stop")
         self.process.sendline("clear")
 
+    def drain_output(self):
+        """ Throw away output nobody read, like a status reply that arrived after get_state gave up on it. """
+        try:
+            while True:
+                self.process.read_nonblocking(size=4096, timeout=0)
+        except (pexpect.TIMEOUT, pexpect.EOF):
+            pass
+        self.process.buffer = self.process.buffer[:0]
+
     def get_state(self):
+        # Otherwise a late reply would be matched as the answer to this request.
+        self.drain_output()
         self.process.sendline("status")
-        self.process.expect("\( state (\w+) \)")
+        # expect() returns as soon as VLC answers, the timeout only bounds an unresponsive VLC.
+        try:
+            self.process.expect("\( state (\w+) \)", timeout=self.state_timeout)
+        except pexpect.TIMEOUT:
+            logger.warning("VLC did not report its state.")
+            return ""
         if( len(self.process.match.groups()) == 0 ):
             return ""
         return str(self.process.match.groups()[0], "utf-8")
 
     def add_track_mrls(self, track_list):
         self.clear_playlist()
-        for track in sorted(track_list):
-            self.process.sendline( "enqueue " + track + "\n")
-        self.process.sendline("sort\n")
+        # track_list arrives sorted, so VLC doesn't need to re-sort the playlist.
+        # All commands go out in one write, pexpect pauses for delaybeforesend before every send.
+        commands = "".join("enqueue " + track + "\n" for track in track_list).encode("utf-8")
+        while commands:
+            commands = commands[self.process.send(commands):]
 
 
 @dataclass
@@ -206,6 +380,11 @@ class NFCPlayer:
     _BATCH_MODE = False
     _CHECK_MODE = False
     batch_dirs = []
+    batch_flush_size = 10
+    prefetch_tracks = 2
+    _pending_writes = None
+    _pending_removals = None
+    _dir_cache = None
     halt = False
 
     standby_options = None
@@ -221,8 +400,12 @@ class NFCPlayer:
 
         location = args["location"]
         self.default_directory = args["default_directory"]
-        self._GUI_MODE = not args["terminal_only"]
+        # None lets set_app_display_mode decide based on whether there is a display.
+        self._GUI_MODE = False if args["terminal_only"] else None
         self._WRITE_MODE = args["write_mode"]
+        self._pending_writes = {}
+        self._pending_removals = {}
+        self._dir_cache = {}
         if args["batch_mode_dir"] is not None:
             self._WRITE_MODE = True
             self._BATCH_MODE = True
@@ -240,7 +423,7 @@ class NFCPlayer:
             'on-startup': self.on_startup,
             'on-connect': self.read_and_play,
             'on-release': self.on_release,
-            'interval': 0.5,
+            'interval': args["poll_interval"],
             'beep-on-connect': False
         }
 
@@ -248,11 +431,13 @@ class NFCPlayer:
             'on-startup': self.on_startup,
             'on-connect': self.read_and_assign,
             'on-release': self.on_release,
-            'interval': 0.5,
+            'interval': args["poll_interval"],
             'beep-on-connect': False
         }
 
         if self._CHECK_MODE == False:
+            # nfcpy pulls in libusb and the reader drivers, --check_paths never needs them.
+            import nfc
             logger.debug(f"Looking for NFC card reader at '{location}'")
             self.clf = nfc.ContactlessFrontend()
 
@@ -276,7 +461,9 @@ class NFCPlayer:
 
         self.set_app_display_mode()
 
-        self.VLC = VLC()
+        # Only playback needs VLC, starting it here keeps the first tap fast.
+        if (self._CHECK_MODE == False) and (self._WRITE_MODE == False):
+            self.VLC = VLC()
         self.DB = Database()
 
         logger.debug(f"NFC Player initialized.")
@@ -291,13 +478,20 @@ class NFCPlayer:
         logger.debug("Closing connection to NFC Card Reader")
         if self.clf is not None:
             self.clf.close()
+        if self.DB is not None:
+            try:
+                self.flush_pending_writes()
+            except sqlite3.Error:
+                # Already logged by flush_pending_writes, carry on shutting down.
+                pass
+            self.DB.close()
         logger.debug("Releasing VLC Instance")
         if self.VLC is not None:
             self.VLC.kill()
 
     def on_startup(self, targets):
         for target in targets:
-            target.sensf_req = bytearray.fromhex("0012FC0000")
+            target.sensf_req = _SENSF_REQ
         return targets
 
     def set_app_display_mode(self):
@@ -305,41 +499,47 @@ class NFCPlayer:
             logger.info(f"Terminal only mode.")
         elif self._GUI_MODE is None:
             logger.info(f"Checking for display...")
-            if 'DISPLAY' in os.environ:
+            if _HAS_DISPLAY:
                 self._GUI_MODE = True
             else:
                 self._GUI_MODE = False
 
     # Main functionalities
     def on_release(self, event=""):
-        self.VLC.pause()
+        if self.VLC is not None:
+            self.VLC.pause()
         return True
 
     def get_uuid_from_tag(self):
         if (self.tag is None) or (self.tag.Tag.is_present == False):
             return None
-        if (self.tag.Tag.ndef is None):
+        # Read the NDEF attribute once, each access can go out to the reader.
+        ndef = self.tag.Tag.ndef
+        if (ndef is None):
             if self._WRITE_MODE:
                 logger.info(f"Tag is empty.")
                 return None
             else:
                 logger.info("Tag doesn't have a valid ID, please try another tag.")
         
-        logger.info(f"Getting tag UUID")
+        logger.info("Getting tag UUID")
         try:
-            l = message_decoder(self.tag.Tag.ndef.octets)
+            # Only the first record is needed, don't decode the rest.
+            record = next(message_decoder(ndef.octets), None)
         except AttributeError:
             return None
         
-        if len(list(l)) > 0:
-            uuid = list(message_decoder(self.tag.Tag.ndef.octets))[0].text
-            logger.debug(f"Tag UUID: {uuid}")
+        # Tags written by other apps can carry URI or other non-text records.
+        if isinstance(record, TextRecord):
+            uuid = record.text
+            logger.debug("Tag UUID: %s", uuid)
             return uuid
         else:
             return None
 
     def play_loop(self):
         logger.debug(f"Going into standby mode.")
+        threading.Thread(target=self.warm_directory_cache, daemon=True).start()
         print("Ready to play")
         while True:
             try:
@@ -347,7 +547,6 @@ class NFCPlayer:
                 if self.clf.connect(rdwr=self.standby_options) == False:
                     logger.debug("Could not connect to card")
                     break
-                self.VLC.pause()
             except KeyboardInterrupt:
                 print()
                 break
@@ -356,7 +555,7 @@ class NFCPlayer:
 
     def read_and_play(self, tag):
         logger.info("Connected to tag.")
-        logger.debug(f"Tag: {tag}")
+        logger.debug("Tag: %s", tag)
         self.tag = Tag(tag)
 
         self.tag.UUID = self.get_uuid_from_tag()
@@ -378,9 +577,11 @@ class NFCPlayer:
         return True
 
     def write_loop(self):
+        import nfc
         print(f"NFC Music Player {_VERSION}, ready to write.")
         
-        while True and not xor(bool(self._BATCH_MODE), bool(len(self.batch_dirs) > 0)):
+        # Batch mode runs until its directories are used up, otherwise until the user quits.
+        while (self._BATCH_MODE == False) or self.batch_dirs:
             logger.debug("Entering write_loop")
             # Print messages only if coming for a new tag.
             if self.reprint:
@@ -414,19 +615,43 @@ class NFCPlayer:
             except KeyboardInterrupt:
                 break
             except nfc.tag.TagCommandError as err:
+                self._pending_writes.pop(self.tag.UUID, None)
+                self._pending_removals.pop(self.tag.UUID, None)
                 self.DB.remove_entry(self.tag.UUID)
                 logger.error(f"NDEF write failed: {str(err)}")
                 logger.error(f"You probably removed the tag before its UUID could be written.")
+        self.flush_pending_writes()
+
+    def flush_pending_writes(self):
+        """ Write queued batch mode entries, and remove the entries they overwrite, in one transaction. """
+        if len(self._pending_writes) == 0:
+            return
+        logger.debug(f"Writing {len(self._pending_writes)} queued entries to DB")
+        try:
+            self.DB.create_entries(list(self._pending_writes.items()), self._pending_removals.values())
+        except sqlite3.Error as e:
+            # Log what was lost so the tags can be reassigned, the queue is dropped either way.
+            logger.error(f"Could not write {len(self._pending_writes)} queued entries to DB: {e}")
+            for uuid, path in self._pending_writes.items():
+                logger.error(f"Not written: {uuid}, {path}")
+            raise
+        finally:
+            self._pending_writes = {}
+            self._pending_removals = {}
 
     def read_and_assign(self, tag):
         try:
             self.reprint = True
             print("Checking")
             logger.info("Connected to tag.")
-            logger.debug(f"Tag: {tag}")
+            logger.debug("Tag: %s", tag)
             self.tag = Tag(tag)
             self.tag.UUID = self.get_uuid_from_tag()
-            self.tag.Path = self.DB.get_path(self.tag.UUID, True)
+            # Tags written earlier in this batch are only queued, look there before the DB.
+            self.tag.Path = self._pending_writes.get(self.tag.UUID)
+            if self.tag.Path is None:
+                self.tag.Path = self.DB.get_path(self.tag.UUID, True)
+            old_uuid = None
 
             if (self.tag.Path is not None):
                 print(f"Tag is already pointing to: {self.tag.Path}")
@@ -437,10 +662,10 @@ class NFCPlayer:
                     print(f"Please remove tag.")
                     return True
                 else:
-                    self.DB.remove_entry(self.tag.UUID)
+                    old_uuid = self.tag.UUID
             
             # Get random UUID.
-            self.tag.UUID = "NFCMP_" + str(uuid.uuid4())
+            self.tag.UUID = new_tag_uuid()
             
             # Prompt user to select/input a media directory.
             if self._BATCH_MODE:
@@ -452,15 +677,35 @@ class NFCPlayer:
                     self.tag.Path = self.select_media_directory()
             
             # Try to write the uuid to the tag.
-            self.tag.Tag.ndef.records = [TextRecord(self.tag.UUID)]
-
-            # Try to create DB entry.
-            self.DB.create_entry(self.tag.UUID, self.tag.Path)
+            ndef = self.tag.Tag.ndef
+            ndef.records = [TextRecord(self.tag.UUID)]
 
-            # Check
-            if ( self.tag.UUID == list(message_decoder(self.tag.Tag.ndef.octets))[0].text ) and \
-                ( self.DB.get_path(self.tag.UUID, True) == self.tag.Path ):
+            # Try to create DB entry, dropping the overwritten one.
+            # Batch mode queues both and commits every batch_flush_size tags.
+            if self._BATCH_MODE:
+                if old_uuid in self._pending_writes:
+                    # The overwritten row never reached the DB, drop it and carry over the removal it was queued with.
+                    del self._pending_writes[old_uuid]
+                    old_uuid = self._pending_removals.pop(old_uuid, None)
+                if old_uuid is not None:
+                    self._pending_removals[self.tag.UUID] = old_uuid
+                self._pending_writes[self.tag.UUID] = self.tag.Path
+                if len(self._pending_writes) >= self.batch_flush_size:
+                    self.flush_pending_writes()
+            else:
+                self.DB.replace_entry(old_uuid, self.tag.UUID, self.tag.Path)
+
+            # Check against the records nfcpy kept from the write instead of reading the tag back.
+            records = ndef.records
+            written = ( len(records) > 0 ) and ( self.tag.UUID == records[0].text )
+            if written and (self.tag.UUID in self._pending_writes):
+                # Not in the DB yet, flush_pending_writes commits it with the rest of the batch.
+                logger.info(f"Queued entry for DB: \n\t{self.tag.UUID},\n\t{self.tag.Path}")
+            elif written and (self.DB.get_path(self.tag.UUID, True) == self.tag.Path):
                 logger.info(f"Succesfully added entry to DB: \n\t{self.tag.UUID},\n\t{self.tag.Path}")
+            else:
+                written = False
+            if written:
                 print(self.success_ascii_msg)
                 print("Succesfully assigned media to tag.")
             else:
@@ -478,46 +723,60 @@ class NFCPlayer:
     def add_media_to_playlist(self, directory):
         print(directory)
         if os.path.isfile(directory):
-            self.VLC.add_track_mrls(directory)
+            track_list = [directory]
         else:
-            track_list = []
-            for file_name in os.listdir(directory):
-                file = os.path.join(directory, file_name)
-                #if self.is_playlist(file):
-                #    track_list = [file]
-                #    logger.info(f"Found playlist file {file} making that the playlist")
-                #    return
-                if (self.is_audio_track(file)) and (self.is_playlist(file) == False):
-                    track_list.append(file)
-            self.VLC.add_track_mrls(track_list)
-            logger.info(f"Added {len(track_list)} songs to playlist")
+            track_list = self.get_audio_tracks(directory)
+        # Warm the page cache for the opening tracks while VLC sets up the playlist.
+        for track in track_list[:self.prefetch_tracks]:
+            prefetch_file(track)
+        self.VLC.add_track_mrls(track_list)
+        logger.info("Added %d songs to playlist", len(track_list))
+
+    def warm_directory_cache(self):
+        """ Scan every assigned directory in advance so the first tap of a tag doesn't wait on the listing. """
+        for path in list(self.DB.get_all_paths()):
+            try:
+                if os.path.isdir(path):
+                    self.get_audio_tracks(path)
+            except OSError:
+                continue
+        logger.debug("Directory cache warmed.")
 
     def load_batch_directories_file(self, file):
-        f = open(os.path.realpath(os.path.expanduser(file)), 'r')
-        logger.debug(os.path.realpath(os.path.expanduser(file)))
-        for line in f:
-            if os.path.exists(os.path.expanduser(line.strip())):
-                self.batch_dirs.append(os.path.expanduser(line.strip()))
+        batch_file = os.path.realpath(os.path.expanduser(file))
+        logger.debug("%s", batch_file)
+        with open(batch_file, 'r') as f:
+            paths = [os.path.expanduser(line.strip()) for line in f if line.strip()]
+        self.batch_dirs.extend(path for path in paths if os.path.exists(path))
         logger.info(f"Found {len(self.batch_dirs)} paths")
 
     def check_paths(self):
-        paths = self.DB.get_all_paths()
-        for path in paths:
-            if self.check_if_directory_contains_media(path[0]) == False:
-                print(path[0])
+        paths = list(self.DB.get_all_paths())
+        # Scanning is blocking filesystem I/O, so threads overlap the directories well.
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = executor.map(self.check_if_directory_contains_media, paths)
+            for path, has_media in zip(paths, results):
+                if has_media == False:
+                    print(path)
     
     def select_media_directory(self):
         directory = None
         if self._GUI_MODE:
             logger.info("Opening file dialog...")
+            # Tkinter is only loaded once a dialog is actually needed.
+            try:
+                from tkinter import filedialog, TclError
+            except ImportError:
+                self._GUI_MODE = False
+                logger.info(f"Tkinter is not available. Falling back to terminal only mode.")
         
         while directory is None:
             if self._GUI_MODE:
                 try:
-                    directory = filedialog.askdirectory( title="Select a media folder\t\t\t\t\t\t\t\t\t\t\t\t", initialdir=self.default_directory)
-                    # When window is closed without selecting it generates a tuple.
+                    directory = self.run_dialog_watching_tag(filedialog.askdirectory, title="Select a media folder\t\t\t\t\t\t\t\t\t\t\t\t", initialdir=self.default_directory)
+                    # When window is closed without selecting it generates an empty tuple or string, depending on the Tk version.
                     # Use that as a signal to determine if user wants to end the program.
-                    if type(directory) == tuple:
+                    if not directory:
                         ans = ""
                         while ans.upper() not in ["Y","N"]:
                             ans = input("End the program: Y/N? ")
@@ -536,13 +795,28 @@ class NFCPlayer:
                     continue
             else:
                 directory = input("Input path to media: ")
-                if directory == "\n" or directory == "":
+                if directory.strip() == "":
                     directory = None
                     continue
         directory = os.path.normpath(os.path.expanduser(directory.strip().strip('\'').strip('\"')))
         logger.debug(f"Selected {directory}")
         return directory
 
+    def run_dialog_watching_tag(self, dialog, **kwargs):
+        """ Run a blocking dialog while a helper thread checks the tag is still on the reader. """
+        done = threading.Event()
+        def watch():
+            while done.wait(0.5) == False:
+                if (self.tag is not None) and (self.tag.Tag.is_present == False):
+                    print("Tag was removed, place it back on the reader before selecting a folder.")
+                    return
+        # Tk has to stay on the thread that called it (the main thread on macOS), so only the tag check moves off it.
+        threading.Thread(target=watch, daemon=True).start()
+        try:
+            return dialog(**kwargs)
+        finally:
+            done.set()
+
     def check_if_directory_contains_media(self, path):
         if path is None:
             return False
@@ -551,11 +825,7 @@ class NFCPlayer:
                 logger.warning(f"Not a valid path.")
             return False
 
-        tracks = 0
-        for file_name in sorted(os.listdir(path)):
-            file = os.path.join(path, file_name)
-            if self.is_audio_track(file):
-                tracks += 1
+        tracks = len(self.get_audio_tracks(path))
         if tracks > 0:
             if self._CHECK_MODE == False:
                 print(f"Found {tracks} tracks in directory {path}.")
@@ -565,20 +835,40 @@ class NFCPlayer:
                 logger.warning(f"No tracks found in directory.")
         return False
 
+    def get_audio_tracks(self, directory):
+        """ List the audio tracks in a directory in name order, reusing the last scan while the directory is unchanged. """
+        # DB paths come back from get_path normalized, batch entries aren't, so key the cache on one form.
+        directory = os.path.normpath(directory)
+        mtime = os.stat(directory).st_mtime
+        cached = self._dir_cache.get(directory)
+        if (cached is not None) and (cached[0] == mtime):
+            return cached[1]
+        with os.scandir(directory) as entries:
+            track_list = [entry.path for entry in entries if self.is_audio_track(entry)]
+        # Paths share the directory prefix, so this is name order.
+        track_list.sort()
+        self._dir_cache[directory] = (mtime, track_list)
+        return track_list
+
     def is_playlist(self, file):
-        ext =  os.path.splitext(file)[1]
-        if(ext.upper() in [".M3U", ".ASX", ".XSPF", ".B4S", ".CUE"]):
-            return True
-        return False
+        return os.path.splitext(file)[1].lower() in _PLAYLIST_EXTS
 
     def is_audio_track(self, file):
-        if os.path.isfile(file):
-            mime_type = mimetypes.guess_type(file)[0]
-            if (mime_type is not None) and (self.is_playlist(file) == False) and mime_type.startswith("audio"):
-                logger.debug(f"{file} is an audio track.")
+        # Entries from os.scandir already know whether they are files, so skip the stat.
+        if isinstance(file, os.DirEntry):
+            name = file.name
+            is_file = file.is_file()
+            file = file.path
+        else:
+            name = os.path.basename(file)
+            is_file = os.path.isfile(file)
+        if is_file:
+            # Slicing from the last dot is cheaper than os.path.splitext or a regex search.
+            if name[name.rfind('.'):].lower() in _AUDIO_EXTS:
+                logger.debug("%s is an audio track.", file)
                 return True
             else:
-                logger.debug(f"{file} is not an audio track.")
+                logger.debug("%s is not an audio track.", file)
 
 parser = argparse.ArgumentParser(
                     prog='NFC Player',
@@ -602,6 +892,10 @@ parser.add_argument('-b', '--batch_mode',
                     help='Write tags sequentially from a file containing a list of directories.',
                     default=None, dest="batch_mode_dir")
 
+parser.add_argument('-i', '--poll_interval',
+                    help='Seconds between NFC reader polls. Lower picks up tags faster, higher uses less CPU and power. Defaults to 0.5.',
+                    type=float, default=0.5)
+
 parser.add_argument('-c', '--check_paths',
                     help='Check if paths in the database are valid, real and contain media. Write invalid paths to stdout.',
                     action='store_true')
@@ -625,12 +919,12 @@ signal.signal(signal.SIGTERM, sig_handler)
 
 def main():
     # Set whole logger to lowest level to enable different log levels.
-    # And fileHandler to verbose unless debug is enabled.
+    # And the file log to verbose unless debug is enabled.
     logger.setLevel(level=logging.DEBUG)
     if args.log_level == logging.DEBUG:
-        fileHandler.setLevel(level=logging.DEBUG)
+        bufferedFileHandler.setLevel(level=logging.DEBUG)
     else:
-        fileHandler.setLevel(level=logging.INFO)
+        bufferedFileHandler.setLevel(level=logging.INFO)
     stdoutHandler.setLevel(level=args.log_level)
     clear_screen()
     logger.info('')